@@ -301,12 +301,22 @@ class GameState:
         damage = 1
         is_ranged = False
         
+        arrow = None
+        if weapon and weapon.name == "弓":
+            is_ranged = True
+            # 检查是否有箭
+            arrow = next((i for i in attacker.inventory if i.name == "箭"), None)
+            if not arrow: return False, "没有箭"
+
+        # 距离判定（先于消耗，失败的攻击不改变任何状态）
+        if not is_ranged and attacker.pos != target.pos:
+            return False, "距离太远"
+        if is_ranged:
+            if "决胜之地" in [attacker.pos, target.pos]:
+                return False, "决胜之地无法进行远程攻击"
+
         if weapon:
-            if weapon.name == "弓":
-                is_ranged = True
-                # 检查是否有箭
-                arrow = next((i for i in attacker.inventory if i.name == "箭"), None)
-                if not arrow: return False, "没有箭"
+            if is_ranged:
                 attacker.remove_item(arrow.id) # 消耗箭
                 damage = 2 # 箭伤害
             else:
@@ -318,13 +328,6 @@ class GameState:
                         attacker.remove_item(weapon.id)
                         self.log(f"{attacker.name} 的 {weapon.name} 损坏了！")
 
-        # 距离判定
-        if not is_ranged and attacker.pos != target.pos:
-            return False, "距离太远"
-        if is_ranged:
-            if "决胜之地" in [attacker.pos, target.pos]:
-                return False, "决胜之地无法进行远程攻击"
-
         # 伤害计算
         final_damage = damage
         if "berserk" in attacker.buffs:
@@ -1,12 +1,83 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
+import asyncio
 import json
+import time
 import uuid
-from typing import List, Dict
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import List, Dict, Optional
 from game_core import game
 
-app = FastAPI()
+# 限流与过载保护参数
+CLIENT_RATE = 5.0            # 单连接每秒补充的令牌数
+CLIENT_BURST = 10            # 单连接令牌桶容量
+ROOM_RATE = 30.0             # 整个房间每秒可处理的消息数（按连接数均分）
+ROOM_BURST = 60              # 整个房间的突发上限（按连接数均分）
+RATE_VIOLATION_WINDOW = 10.0 # 统计被限流次数的滑动窗口（秒）
+MAX_RATE_VIOLATIONS = 50     # 窗口内被限流达到该次数则断开连接
+LAG_CHECK_INTERVAL = 0.5     # 事件循环延迟采样间隔（秒）
+MAX_LOOP_LAG = 0.2           # 事件循环延迟超过该值（秒）时拒绝新连接
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def peek(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def consume(self):
+        if not self.peek():
+            return False
+        self.tokens -= 1
+        return True
+
+class LoopLagMonitor:
+    def __init__(self, interval: float, max_lag: float):
+        self.interval = interval
+        self.max_lag = max_lag
+        self.lag = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # 保留任务引用，事件循环只持有弱引用
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        # 定期休眠，实际唤醒时间与预期的差值即为事件循环延迟
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.monotonic() - start - self.interval)
+
+    def overloaded(self):
+        return self.lag > self.max_lag
+
+lag_monitor = LoopLagMonitor(LAG_CHECK_INTERVAL, MAX_LOOP_LAG)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    lag_monitor.start()
+    yield
+    await lag_monitor.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # 挂载静态文件，用于访问 index.html
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -18,14 +89,32 @@ async def get():
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
+        self.connection_count = 0 # 存活的连接数（同一 id 的多个连接分别计数）
 
     async def connect(self, websocket: WebSocket, client_id: str):
         await websocket.accept()
+        self.connection_count += 1
         self.active_connections[client_id] = websocket
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
+    def disconnect(self, client_id: str, websocket: WebSocket):
+        self.connection_count -= 1
+        # 同一 id 重连后，旧连接的清理不能影响新连接
+        if self.active_connections.get(client_id) is websocket:
             del self.active_connections[client_id]
+            return True
+        return False
+
+    def allow(self, bucket: TokenBucket, share: TokenBucket):
+        # 先扣除单连接配额：无论房间是否繁忙，每条消息都计入发送者自身的速率
+        if not bucket.consume():
+            return False, "client"
+        # 房间配额按连接数均分，各份额之和即为房间上限，多开连接也无法挤占其他玩家
+        n = max(1, self.connection_count)
+        share.rate = ROOM_RATE / n
+        share.capacity = max(1.0, ROOM_BURST / n)
+        if not share.consume():
+            return False, "room"
+        return True, ""
 
     async def broadcast_game_state(self):
         for client_id, websocket in self.active_connections.items():
@@ -40,13 +129,39 @@ manager = ConnectionManager()
 
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
+    # 服务器过载时拒绝新连接（1013: Try Again Later），需先完成握手客户端才能收到关闭码
+    if lag_monitor.overloaded():
+        await websocket.accept()
+        await websocket.close(code=1013)
+        return
+
     await manager.connect(websocket, client_id)
+    bucket = TokenBucket(CLIENT_RATE, CLIENT_BURST)
+    share = TokenBucket(ROOM_RATE, ROOM_BURST)
+    violations = deque()
     try:
         # 发送初始状态
         await websocket.send_json({"type": "state", "data": game.get_snapshot(observer_id=client_id)})
         
         while True:
             data = await websocket.receive_json()
+
+            allowed, limit = manager.allow(bucket, share)
+            if not allowed and limit == "room":
+                # 房间整体繁忙并非该客户端的责任：不计入违规，告知操作未执行
+                await websocket.send_json({"type": "error", "message": "服务器繁忙，操作未执行，请稍后重试"})
+                continue
+            # 超出自身配额的消息直接丢弃，不回复；窗口内被限流过多则断开
+            if not allowed:
+                now = time.monotonic()
+                violations.append(now)
+                while violations[0] < now - RATE_VIOLATION_WINDOW:
+                    violations.popleft()
+                if len(violations) >= MAX_RATE_VIOLATIONS:
+                    await websocket.close(code=1008)
+                    raise WebSocketDisconnect(code=1008)
+                continue
+
             action = data.get("action")
             payload = data.get("payload", {})
             
@@ -97,13 +212,17 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                 success, msg = game.tame(client_id)
                 response = {"success": success, "message": msg}
             
-            # 广播最新的游戏状态
-            await manager.broadcast_game_state()
+            # 操作失败时游戏状态未改变，无需广播
+            if response["success"]:
+                await manager.broadcast_game_state()
             
             # 发送操作结果给当前用户（可选）
             # await websocket.send_json({"type": "response", "data": response})
             
     except WebSocketDisconnect:
-        manager.disconnect(client_id)
-        game.remove_player(client_id)
-        await manager.broadcast_game_state()
+        pass
+    finally:
+        # 任何原因退出都要释放连接计数，否则该来源会被永久占满
+        if manager.disconnect(client_id, websocket):
+            game.remove_player(client_id)
+            await manager.broadcast_game_state()